@@ -9,7 +9,7 @@ from masked_cross_entropy import *
 import itertools
 import random
 import math
-from load import SOS_ID, EOS_ID, PAD_ID
+from load import SOS_ID, EOS_ID, PAD_ID, loadAspectIds, isSketchEmbeddingShared
 from model import ReviewAttnDecoderRNN, TopicAttnDecoderRNN, SketchAttnDecoderRNN, AttributeEncoder
 import pickle
 import logging
@@ -384,8 +384,7 @@ def runTest(corpus, n_layers, hidden_size, embed_size, attr_size, attr_num, over
     attr_embeddings.append(nn.Embedding(num_over, attr_size))
 
     if USE_CUDA:
-        for attr_embedding in attr_embeddings:
-            attr_embedding = attr_embedding.cuda()
+        attr_embeddings = [attr_embedding.cuda() for attr_embedding in attr_embeddings]
 
     topic_encoder = AttributeEncoder(attr_size, attr_num, hidden_size, attr_embeddings, n_layers)
 
@@ -417,8 +416,7 @@ def runTest(corpus, n_layers, hidden_size, embed_size, attr_size, attr_num, over
     attr_embeddings.append(nn.Embedding(num_over, attr_size))
 
     if USE_CUDA:
-        for attr_embedding in attr_embeddings:
-            attr_embedding = attr_embedding.cuda()
+        attr_embeddings = [attr_embedding.cuda() for attr_embedding in attr_embeddings]
 
     sketch_encoder = AttributeEncoder(attr_size, attr_num, hidden_size, attr_embeddings, n_layers)
 
@@ -451,12 +449,13 @@ def runTest(corpus, n_layers, hidden_size, embed_size, attr_size, attr_num, over
     attr_embeddings.append(nn.Embedding(num_item, attr_size))
     attr_embeddings.append(nn.Embedding(num_over, attr_size))
     if USE_CUDA:
-        for attr_embedding in attr_embeddings:
-            attr_embedding = attr_embedding.cuda()
+        attr_embeddings = [attr_embedding.cuda() for attr_embedding in attr_embeddings]
 
     review_encoder = AttributeEncoder(attr_size, attr_num, hidden_size, attr_embeddings, n_layers)
 
-    # birnn encoder
+    checkpoint = torch.load(rv_modelFile)
+
+    # birnn encoder, its sketch embedding is shared with the review decoder unless the checkpoint has two copies
     sketch_embedding = nn.Embedding(vocab.n_sketchs, embed_size)
     if USE_CUDA:
         sketch_embedding = sketch_embedding.cuda()
@@ -465,23 +464,23 @@ def runTest(corpus, n_layers, hidden_size, embed_size, attr_size, attr_num, over
 
     # review decoder
     topic_embedding = nn.Embedding(vocab.n_topics, embed_size)
-    sketch_embedding = nn.Embedding(vocab.n_sketchs, embed_size)
     word_embedding = nn.Embedding(vocab.n_words, embed_size)
 
-    with open(os.path.join(save_dir, 'aspect_ids.pkl'), 'rb') as fp:
-        ids = pickle.load(fp)
-
-    aspect_ids = nn.Embedding(vocab.n_topics-3, 100)
-    aspect_ids.weight.data.copy_(torch.from_numpy(np.array(ids)))
+    ids = loadAspectIds(save_dir)
+    assert ids.size(0) == vocab.n_topics-3, 'Expected 100 aspect ids for each of the {} topics'.format(vocab.n_topics-3)
+    aspect_ids = nn.Embedding.from_pretrained(ids.float(), freeze=True)  # (n_topics-3, 100)
 
     if USE_CUDA:
         topic_embedding = topic_embedding.cuda()
-        sketch_embedding = sketch_embedding.cuda()
         word_embedding = word_embedding.cuda()
 
+    if not isSketchEmbeddingShared(checkpoint):
+        sketch_embedding = nn.Embedding(vocab.n_sketchs, embed_size)
+        if USE_CUDA:
+            sketch_embedding = sketch_embedding.cuda()
+
     review_decoder = ReviewAttnDecoderRNN(topic_embedding, sketch_embedding, word_embedding, embed_size, hidden_size, attr_size, vocab.n_words, aspect_ids, n_layers)
 
-    checkpoint = torch.load(rv_modelFile)
     review_encoder.load_state_dict(checkpoint['encoder'])
     birnn_encoder.load_state_dict(checkpoint['birnn_encoder'])
     review_decoder.load_state_dict(checkpoint['review_decoder'])
@@ -90,4 +90,24 @@ def loadPrepareData(corpus_name, save_dir):
         train_pairs, valid_pairs, test_pairs = prepareData(vocab, corpus_name, save_dir)
     return vocab, train_pairs, valid_pairs, test_pairs
 
+# aspect ids are cached as a LongTensor so that they load straight into the embedding.
+# aspect_ids.pkl is a flat list of the top 100 word ids of every topic, returned as (topics, 100)
+def loadAspectIds(save_dir):
+    path = os.path.join(save_dir, 'aspect_ids.pt')
+    try:
+        ids = torch.load(path)
+    except FileNotFoundError:
+        print("Saved aspect ids not found, converting aspect_ids.pkl ...")
+        with open(os.path.join(save_dir, 'aspect_ids.pkl'), 'rb') as fp:
+            ids = torch.LongTensor(pickle.load(fp)).view(-1, 100)
+        torch.save(ids, path)
+    return ids.view(-1, 100)
+
+# review checkpoints trained before the sketch embedding was shared between the birnn encoder
+# and the review decoder hold two different copies of it, which must not be loaded into one module
+def isSketchEmbeddingShared(checkpoint):
+    if checkpoint is None:
+        return True
+    return torch.equal(checkpoint['birnn_encoder']['sketch_embedding.weight'].cpu(),
+                       checkpoint['review_decoder']['sketch_embedding.weight'].cpu())
 
@@ -28,6 +28,7 @@ def parse():
     parser.add_argument('-mn', '--min_length', type=int, default=10, help='min length of sequence')
 
     parser.add_argument('-sd', '--save_dir', help='saved directory of model')
+    parser.add_argument('-ck', '--checkpoint', action='store_true', help='use gradient checkpointing to save memory')
 
     args = parser.parse_args()
     return args
@@ -47,12 +48,12 @@ def run(args):
         
     if args.train and not args.load:
         trainIters(args.train, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size,
-                    n_layers, hidden_size, embed_size, attr_size, attr_num, overall, save_dir)
+                    n_layers, hidden_size, embed_size, attr_size, attr_num, overall, save_dir, use_checkpoint=args.checkpoint)
                     
     elif args.load:
         n_layers, hidden_size = parseFilename(args.load)
         trainIters(args.train, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size,
-                    n_layers, hidden_size, embed_size, attr_size, attr_num, overall, save_dir, loadFilename=args.load)
+                    n_layers, hidden_size, embed_size, attr_size, attr_num, overall, save_dir, loadFilename=args.load, use_checkpoint=args.checkpoint)
     
     elif args.test: 
         n_layers, hidden_size = parseFilename(args.review_model)
@@ -2,6 +2,8 @@ import torch
 from torch.nn import functional
 from torch.autograd import Variable
 
+IGNORE_ID = -100
+
 def sequence_mask(sequence_length, max_len=None):
     if max_len is None:
         max_len = sequence_length.data.max()
@@ -21,27 +23,14 @@ def masked_cross_entropy(logits, target, mask):
         loss: An average loss value masked by the length.
     """
 
-    # logits_flat: (batch * max_len, num_classes)
-    logits_flat = logits.view(-1, logits.size(-1))
-    
-    # log_probs_flat: (batch * max_len, num_classes)
-    log_probs_flat = functional.log_softmax(logits_flat, dim=1)
-    
-    # target_flat: (batch * max_len, 1)
-    target_flat = target.view(-1, 1)
-    
-    # losses_flat: (batch * max_len, 1)
-    losses_flat = -torch.gather(log_probs_flat, dim=1, index=target_flat)
-    
-    # losses: (batch, max_len)
-    losses = losses_flat.view(*target.size())
-    
-    # mask: (batch, max_len)
-    loss = losses.masked_select(mask)
-    if len(loss) > 0:
-        loss = loss.mean()
-    else:
-        loss = Variable(torch.zeros(1))
-        loss = loss.cuda()
+    # positions outside the mask are skipped by the fused log_softmax + nll kernel
+    target = target.masked_fill(~mask.bool(), IGNORE_ID)
+
+    # logits_flat: (batch * max_len, num_classes), target_flat: (batch * max_len)
+    logits_flat = logits.reshape(-1, logits.size(-1))
+    target_flat = target.reshape(-1)
+
+    loss = functional.cross_entropy(logits_flat, target_flat, ignore_index=IGNORE_ID, reduction='sum')
     
-    return loss
+    # average over the masked positions, an empty mask gives zero loss
+    return loss / mask.sum().clamp(min=1)
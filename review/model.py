@@ -3,6 +3,7 @@ import torch
 from torch import nn
 from torch.autograd import Variable
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import math
 import numpy as np
 
@@ -17,19 +18,28 @@ class EncoderRNN(nn.Module):
         # batch_first = False 
         self.gru = nn.GRU(embed_size, hidden_size, n_layers, dropout=dropout, bidirectional=True)
     
-    def forward(self, input_seq, hidden=None):
+    def forward(self, input_seq, hidden=None, lengths=None):
         '''
         :param input_seqs: 
-            Variable of shape (num_step(T),batch_size(B)), sorted decreasingly by lengths(for packing)
+            Variable of shape (num_step(T),batch_size(B)), padded at the end
         :param hidden:
             initial state of GRU
+        :param lengths:
+            unpadded lengths in shape (B), on cpu; the padded steps are skipped when given
         :returns:
             GRU outputs in shape (N,B,hidden_size(H))
             last hidden stat of RNN(i.e. last output for GRU)
         '''
         embedded = self.sketch_embedding(input_seq)
 
-        outputs, hidden = self.gru(embedded, hidden) # output: (seq_len, batch, hidden*n_direction)
+        # weights of DataParallel replicas are not contiguous until flattened again
+        self.gru.flatten_parameters()
+        if lengths is None:
+            outputs, hidden = self.gru(embedded, hidden) # output: (seq_len, batch, hidden*n_direction)
+        else:
+            packed = pack_padded_sequence(embedded, lengths, enforce_sorted=False)
+            outputs, hidden = self.gru(packed, hidden)
+            outputs, _ = pad_packed_sequence(outputs, total_length=input_seq.size(0)) # output: (seq_len, batch, hidden*n_direction)
         
         return outputs, hidden
         
@@ -125,7 +135,7 @@ class AttributeAttn(nn.Module):
         this_batch_size = encoder_outputs.size(1)
 
         H = hidden.repeat(attr_len,1,1,1) # [A,N,B,H]
-        encoder_outputs = encoder_outputs.repeat(seq_len,1,1,1).transpose(0,1).contiguous() # [N,A,B,K] -> [A,N,B,K]
+        encoder_outputs = encoder_outputs.repeat(seq_len,1,1,1).transpose(0,1) # [N,A,B,K] -> [A,N,B,K], cat accepts the strided view
 
         #attn_energies = self.score(H,encoder_outputs) 
         attn_energies = F.tanh(self.score(H,encoder_outputs)) # compute attention score [B,N,A]
@@ -305,12 +315,14 @@ class ReviewAttnDecoderRNN(nn.Module):
         embedded = torch.cat((word_embedded, birnn_embedded), dim=2)
 
         # Get current hidden state from input word and last hidden state
+        self.gru.flatten_parameters()
         rnn_output, hidden = self.gru(embedded, last_hidden)  # o, h  [N=seq_len, B, H]
 
         # Calculate attention
         attn_weights = self.attr_attn(rnn_output, encoder_out) # [N,B,H] x [A,B,K] -> [B,N,A]
-        review_context = attn_weights.bmm(encoder_out.transpose(0, 1).contiguous()) # [B,N,A] x [B,A,K] -> [B,N,K]
-        review_context = review_context.transpose(0, 1).contiguous()        # [B,N,K] -> [N,B,K]
+        # bmm and cat take the transposed views directly, no contiguous copies needed
+        review_context = attn_weights.bmm(encoder_out.transpose(0, 1)) # [B,N,A] x [B,A,K] -> [B,N,K]
+        review_context = review_context.transpose(0, 1)        # [B,N,K] -> [N,B,K]
 
         tanh_input = torch.cat((rnn_output, review_context), 2) # [N,B, H+K]
         tanh_output = F.tanh(self.concat(tanh_input))  # [N,B,H]
@@ -330,5 +342,6 @@ class ReviewAttnDecoderRNN(nn.Module):
 
         output.scatter_add_(2, ids, bias_output)
 
-        # Return final output, hidden state
-        return output, hidden, attn_weights
\ No newline at end of file
+        # Return final output, hidden state and attention weights,
+        # all with batch on dim 1 so that DataParallel(dim=1) can gather them
+        return output, hidden, attn_weights.transpose(0, 1)  # attn: [B,N,A] -> [N,B,A]
\ No newline at end of file
@@ -1,10 +1,11 @@
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 from torch import optim
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
+import torch.utils.checkpoint
 from torch.nn.utils.rnn import pack_padded_sequence
+from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
 
 import numpy as np 
@@ -15,132 +16,148 @@ import sys
 import os
 import pickle
 from tqdm import tqdm
-from load import loadPrepareData
+from load import loadPrepareData, loadAspectIds, isSketchEmbeddingShared
 from load import SOS_ID, EOS_ID, PAD_ID
-from model import TopicAttnDecoderRNN, SketchAttnDecoderRNN, ReviewAttnDecoderRNN, AttributeEncoder, EncoderRNN
-from util import batch2TrainData
+from model import ReviewAttnDecoderRNN, AttributeEncoder, EncoderRNN
+from util import batch2TrainData, PairsDataset, Prefetcher
 import time
-from masked_cross_entropy import *
+import functools
+from masked_cross_entropy import masked_cross_entropy
 
 cudnn.benchmark = True
 USE_CUDA = torch.cuda.is_available()
+device = torch.device('cuda' if USE_CUDA else 'cpu')
 
 #############################################
 # Training
 #############################################
 
-def adjust_learning_rate(optimizer, epoch, learning_rate, lr_decay_epoch, lr_decay_ratio):
-    lr = learning_rate * (lr_decay_ratio ** (epoch // lr_decay_epoch))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-        
 def from_pretrained(embeddings, freeze=True):
     assert embeddings.dim() == 2, 'Embeddings parameter is expected to be 2-dimensional'
-    rows, cols = embeddings.shape
-    embedding = torch.nn.Embedding(num_embeddings=rows, embedding_dim=cols)
-    embedding.weight = torch.nn.Parameter(embeddings)
-    embedding.weight.requires_grad = not freeze
-    return embedding
-
-def train(attr_input, topic_input, sketch_output, review_input, review_output, mask, encoder, birnn_encoder, review_decoder, 
-            encoder_optimizer, birnn_encoder_optimizer, review_decoder_optimizer):
-
-    encoder_optimizer.zero_grad()
-    birnn_encoder_optimizer.zero_grad()
-    review_decoder_optimizer.zero_grad()    # 梯度置零
-
-    if USE_CUDA:
-        attr_input = attr_input.cuda() 
-        topic_input = topic_input.cuda()
-        sketch_output = sketch_output.cuda()
-        review_input = review_input.cuda()
-        review_output = review_output.cuda()
-        mask = mask.cuda()
-
-    loss = 0
-    print_losses = []
-
-    # attribute encoder
-    encoder_out, encoder_hidden = encoder(attr_input) # attribute encoder
-
-    # review
-    review_decoder_input = review_input 
-    review_decoder_hidden = encoder_hidden[:review_decoder.n_layers]
-    
-    # use sketch encoder output to concatenate with review input
-    sketch_birnn_output, _ = birnn_encoder(sketch_output)
-
-    # review decoder
-    review_decoder_output, review_decoder_hidden, _ = review_decoder(review_decoder_input, review_decoder_hidden, sketch_birnn_output, topic_input, sketch_output, encoder_out)
-         
-    mask_loss = masked_cross_entropy(review_decoder_output, review_output, mask)
-    loss += mask_loss
-    print_losses.append(mask_loss.data[0])
+    return nn.Embedding.from_pretrained(embeddings, freeze=freeze)
+
+class SketchDataParallel(nn.DataParallel):
+    # split the host-side sketch lengths the same way the batch is scattered (tensor.chunk on the batch dim),
+    # so that each replica packs its own chunk without reading lengths back from the gpu
+    def scatter(self, inputs, kwargs, device_ids):
+        lengths = kwargs.pop('lengths', None)
+        inputs, kwargs = super(SketchDataParallel, self).scatter(inputs, kwargs, device_ids)
+        if lengths is not None:
+            kwargs = tuple(dict(kw, lengths=chunk) for kw, chunk in zip(kwargs, lengths.chunk(len(device_ids))))
+        return inputs, kwargs
+
+def unwrap(module):
+    # DataParallel keeps the wrapped model in .module
+    return module.module if isinstance(module, nn.DataParallel) else module
+
+def run_forward(module, use_checkpoint, *inputs, **kwargs):
+    # recompute activations of the module during backward instead of storing them
+    if use_checkpoint:
+        return torch.utils.checkpoint.checkpoint(module, *inputs, use_reentrant=False, **kwargs)
+    return module(*inputs, **kwargs)
+
+def train(attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths, encoder, birnn_encoder, review_decoder, 
+            optimizer, params, scaler, use_checkpoint=False):
+
+    optimizer.zero_grad(set_to_none=True)    # 梯度置零
+
+    # inputs arrive on the device from the Prefetcher, sketch_lengths stays on the host.
+    # mixed precision forward, autocast is a no-op without cuda
+    with torch.cuda.amp.autocast(enabled=USE_CUDA):
+        # attribute encoder
+        encoder_out, encoder_hidden = run_forward(encoder, use_checkpoint, attr_input) # attribute encoder
+
+        # review
+        review_decoder_input = review_input 
+        review_decoder_hidden = encoder_hidden[:unwrap(review_decoder).n_layers].contiguous()
+        
+        # use sketch encoder output to concatenate with review input
+        sketch_birnn_output, _ = run_forward(birnn_encoder, use_checkpoint, sketch_output, lengths=sketch_lengths)
+
+        # review decoder
+        review_decoder_output, review_decoder_hidden, _ = run_forward(review_decoder, use_checkpoint, review_decoder_input, review_decoder_hidden, 
+                                                                      sketch_birnn_output, topic_input, sketch_output, encoder_out)
+             
+        mask_loss = masked_cross_entropy(review_decoder_output, review_output, mask)
   
-    loss.backward()  # BP process
+    scaler.scale(mask_loss).backward()  # BP process
+
+    # unscale before clipping so that the threshold applies to the true gradients
+    scaler.unscale_(optimizer)
 
     clip = 5.0
-    ec = torch.nn.utils.clip_grad_norm(filter(lambda p: p.requires_grad, encoder.parameters()), clip)
-    bc = torch.nn.utils.clip_grad_norm(filter(lambda p: p.requires_grad, birnn_encoder.parameters()), clip)
-    dc = torch.nn.utils.clip_grad_norm(filter(lambda p: p.requires_grad, review_decoder.parameters()), clip)
+    torch.nn.utils.clip_grad_norm_(params, clip)
 
-    encoder_optimizer.step()
-    birnn_encoder_optimizer.step()
-    review_decoder_optimizer.step()
+    scaler.step(optimizer)
+    scaler.update()
 
-    return sum(print_losses) / len(print_losses)
+    # keep the loss on device, reading it back here would sync every step
+    return mask_loss.detach()
 
-def evaluate(attr_input, topic_input, sketch_output, review_input, review_output, mask, encoder, birnn_encoder, review_decoder, 
-            encoder_optimizer, birnn_encoder_optimizer, review_decoder_optimizer):
+def evaluate(attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths, encoder, birnn_encoder, review_decoder):
 
     encoder.eval()
     birnn_encoder.eval()
     review_decoder.eval()
 
-    if USE_CUDA:
-        attr_input = attr_input.cuda() 
-        topic_input = topic_input.cuda()
-        sketch_output = sketch_output.cuda()
-        review_input = review_input.cuda()
-        review_output = review_output.cuda()
-        mask = mask.cuda()
-
-    loss = 0
-    print_losses = []
-
-    # attribute encoder
-    encoder_out, encoder_hidden = encoder(attr_input) # attribute encoder
-
-    # review
-    review_decoder_input = review_input
-    review_decoder_hidden = encoder_hidden[:review_decoder.n_layers]
-    
-    # use sketch encoder output to concatenate with review input
-    sketch_birnn_output, _ = birnn_encoder(sketch_output)
+    # no backward pass in evaluation, skip autograd bookkeeping
+    with torch.inference_mode():
+        # inputs arrive on the device from the Prefetcher, sketch_lengths stays on the host
+        with torch.cuda.amp.autocast(enabled=USE_CUDA):
+            # attribute encoder
+            encoder_out, encoder_hidden = encoder(attr_input) # attribute encoder
 
-    # review decoder
-    review_decoder_output, review_decoder_hidden, _ = review_decoder(review_input, review_decoder_hidden, sketch_birnn_output, topic_input, sketch_output, encoder_out)
-         
-    mask_loss = masked_cross_entropy(review_decoder_output, review_output, mask)
-    loss += mask_loss
-    print_losses.append(mask_loss.data[0])
-
-    return sum(print_losses) / len(print_losses)
-
-def batchify(pairs, bsz, vocab, evaluation=False):
-    # Work out how cleanly we can divide the dataset into bsz parts.
-    nbatch = len(pairs) // bsz
-    data = []
-    for i in range(nbatch):
-        data.append(batch2TrainData(vocab, pairs[i * bsz: i * bsz + bsz], evaluation))
-    return data
+            # review
+            review_decoder_input = review_input
+            review_decoder_hidden = encoder_hidden[:unwrap(review_decoder).n_layers].contiguous()
+            
+            # use sketch encoder output to concatenate with review input
+            sketch_birnn_output, _ = birnn_encoder(sketch_output, lengths=sketch_lengths)
+
+            # review decoder
+            review_decoder_output, review_decoder_hidden, _ = review_decoder(review_input, review_decoder_hidden, sketch_birnn_output, topic_input, sketch_output, encoder_out)
+                 
+            mask_loss = masked_cross_entropy(review_decoder_output, review_output, mask)
+
+    return mask_loss
+
+def batchify(pairs, bsz, vocab, evaluation=False, num_workers=4):
+    # collate consecutive pairs in worker processes, the loader pins the batches in the main process.
+    # drop_last keeps only the batches that divide the dataset cleanly
+    collate_fn = functools.partial(batch2TrainData, vocab, evaluation=evaluation)
+    loader = DataLoader(PairsDataset(pairs), batch_size=bsz, shuffle=False, drop_last=True, 
+                        num_workers=num_workers, collate_fn=collate_fn, pin_memory=USE_CUDA)
+    return list(loader)
+
+SEQ_FIELDS = ['topic_all', 'sketch_all', 'review_in_all', 'review_out_all', 'mask_all']
+
+def save_batches(batches, path):
+    # store each field as one tensor instead of a list of small tensor tuples. attributes and
+    # sketch lengths stack to (nbatch, B, ...), sequences of different lengths are concatenated on dim 0
+    attr, *seqs, sketch_lens = zip(*batches)
+    data = {'attr_all': torch.stack(attr), 'sketch_lens_all': torch.stack(sketch_lens)}
+    for key, seq in zip(SEQ_FIELDS, seqs):
+        data[key] = torch.cat(seq)
+    data['seq_lens'] = torch.LongTensor([[t.size(0) for t in batch[1:-1]] for batch in batches])  # (nbatch, 5)
+    torch.save(data, path)
+
+def load_batches(path):
+    data = torch.load(path)
+    if USE_CUDA:
+        # pin the few large tensors once, the per-batch views below share their pinned memory
+        data = {key: value if key in ('seq_lens', 'sketch_lens_all') else value.pin_memory() for key, value in data.items()}
+    seq_lens = data['seq_lens'].t().tolist()
+    fields = [data['attr_all'].unbind(0)]
+    fields += [torch.split(data[key], lens) for key, lens in zip(SEQ_FIELDS, seq_lens)]
+    fields.append(data['sketch_lens_all'].unbind(0))
+    return list(zip(*fields))
 
 def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size, n_layers, hidden_size, 
-        embed_size, attr_size, attr_num, overall, save_dir, loadFilename=None):
+        embed_size, attr_size, attr_num, overall, save_dir, loadFilename=None, use_checkpoint=False):
         
     print("corpus={}, learning_rate={}, lr_decay_epoch={}, lr_decay_ratio={}, batch_size={}, n_layers={}, \
-    hidden_size={}, embed_size={}, attr_size={}, attr_num={}, overall={}, save_dir={}".format(corpus, learning_rate, \
-    lr_decay_epoch, lr_decay_ratio, batch_size, n_layers, hidden_size, embed_size, attr_size, attr_num, overall, save_dir))
+    hidden_size={}, embed_size={}, attr_size={}, attr_num={}, overall={}, save_dir={}, use_checkpoint={}".format(corpus, learning_rate, \
+    lr_decay_epoch, lr_decay_ratio, batch_size, n_layers, hidden_size, embed_size, attr_size, attr_num, overall, save_dir, use_checkpoint))
 
     print('load data...')
     vocab, train_pairs, valid_pairs, test_pairs = loadPrepareData(corpus, save_dir)  
@@ -151,37 +168,38 @@ def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size
     corpus_name = corpus
     training_batches = None
     try:
-        training_batches = torch.load(os.path.join(data_path, '{}_{}.tar'.format('training_batches', batch_size)))
+        training_batches = load_batches(os.path.join(data_path, '{}_{}.pt'.format('training_batches', batch_size)))
     except FileNotFoundError:
         print('Training pairs not found, generating ...')
         training_batches = batchify(train_pairs, batch_size, vocab)
         print('Complete building training pairs ...')
-        torch.save(training_batches, os.path.join(data_path, '{}_{}.tar'.format('training_batches', batch_size)))
+        save_batches(training_batches, os.path.join(data_path, '{}_{}.pt'.format('training_batches', batch_size)))
 
     # validation/test data
-    eval_batch_size = 10
+    eval_batch_size = 20
     try:
-        val_batches = torch.load(os.path.join(data_path, '{}_{}.tar'.format('val_batches', eval_batch_size)))
+        val_batches = load_batches(os.path.join(data_path, '{}_{}.pt'.format('val_batches', eval_batch_size)))
     except FileNotFoundError:
         print('Validation pairs not found, generating ...')
         val_batches = batchify(valid_pairs, eval_batch_size, vocab, evaluation=True)  # 测试不需要求导
         print('Complete building validation pairs ...')
-        torch.save(val_batches, os.path.join(data_path, '{}_{}.tar'.format('val_batches', eval_batch_size)))
+        save_batches(val_batches, os.path.join(data_path, '{}_{}.pt'.format('val_batches', eval_batch_size)))
 
     try:
-        test_batches = torch.load(os.path.join(data_path, '{}_{}.tar'.format('test_batches', eval_batch_size)))
+        test_batches = load_batches(os.path.join(data_path, '{}_{}.pt'.format('test_batches', eval_batch_size)))
     except FileNotFoundError:
         print('Test pairs not found, generating ...')
         test_batches = batchify(test_pairs, eval_batch_size, vocab, evaluation=True)
         print('Complete building test pairs ...')
-        torch.save(test_batches, os.path.join(data_path, '{}_{}.tar'.format('test_batches', eval_batch_size)))
+        save_batches(test_batches, os.path.join(data_path, '{}_{}.pt'.format('test_batches', eval_batch_size)))
 
     # aspect
-    with open(os.path.join(save_dir, 'aspect_ids.pkl'), 'rb') as fp:
-        ids = pickle.load(fp)
+    ids = loadAspectIds(save_dir)
 
     # model
     checkpoint = None 
+    if loadFilename:
+        checkpoint = torch.load(loadFilename)
     print('Building encoder and decoder ...')
 
     # topic encoder
@@ -205,12 +223,11 @@ def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size
     attr_embeddings.append(remb)
 
     if USE_CUDA:
-        for attr_embedding in attr_embeddings:
-            attr_embedding = attr_embedding.cuda()
+        attr_embeddings = [attr_embedding.cuda() for attr_embedding in attr_embeddings]
 
     encoder = AttributeEncoder(attr_size, attr_num, hidden_size, attr_embeddings, n_layers)
 
-    # sketch encoder
+    # sketch encoder, its sketch embedding is shared with the review decoder unless the checkpoint has two copies
     sketch_embedding = nn.Embedding(vocab.n_sketchs, embed_size)
     if USE_CUDA:
         sketch_embedding = sketch_embedding.cuda()
@@ -219,23 +236,27 @@ def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size
 
     # review decoder
     topic_embedding = nn.Embedding(vocab.n_topics, embed_size)
-    sketch_embedding = nn.Embedding(vocab.n_sketchs, embed_size)
     word_embedding = nn.Embedding(vocab.n_words, embed_size)
 
     if USE_CUDA:
         topic_embedding = topic_embedding.cuda()
-        sketch_embedding = sketch_embedding.cuda()
         word_embedding = word_embedding.cuda()
 
-    aspect_ids = nn.Embedding(vocab.n_topics-3, 100)  # remove [SOS] [EOS] [PAD]
-    aspect_ids.weight.data.copy_(torch.from_numpy(np.array(ids)))
-    aspect_ids.weight.requires_grad = False 
+    if not isSketchEmbeddingShared(checkpoint):
+        print('{} has separate sketch embeddings for the encoder and decoder, keeping them separate ...'.format(loadFilename))
+        sketch_embedding = nn.Embedding(vocab.n_sketchs, embed_size)
+        if USE_CUDA:
+            sketch_embedding = sketch_embedding.cuda()
+
+    assert ids.size(0) == vocab.n_topics-3, 'Expected 100 aspect ids for each of the {} topics'.format(vocab.n_topics-3)
+    aspect_ids = from_pretrained(ids.float())  # (n_topics-3, 100), remove [SOS] [EOS] [PAD]
+    if USE_CUDA:
+        aspect_ids = aspect_ids.cuda()
     
     attn_model = 'dot'
     review_decoder = ReviewAttnDecoderRNN(topic_embedding, sketch_embedding, word_embedding, embed_size, hidden_size, attr_size, vocab.n_words, aspect_ids, n_layers)
 
     if loadFilename:
-        checkpoint = torch.load(loadFilename)
         encoder.load_state_dict(checkpoint['encoder'])
         birnn_encoder.load_state_dict(checkpoint['birnn_encoder'])
         review_decoder.load_state_dict(checkpoint['review_decoder'])
@@ -246,73 +267,126 @@ def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size
         birnn_encoder = birnn_encoder.cuda()
         review_decoder = review_decoder.cuda()
 
+    # split batches over all visible gpus, sequences are (seq_len, batch) so scatter on dim 1
+    if USE_CUDA and torch.cuda.device_count() > 1:
+        print('Using {} GPUs ...'.format(torch.cuda.device_count()))
+        birnn_encoder = SketchDataParallel(birnn_encoder, dim=1)
+        review_decoder = nn.DataParallel(review_decoder, dim=1)
+
     # optimizer
     print('Building optimizers ...')
-    encoder_optimizer = optim.Adam(filter(lambda p: p.requires_grad, encoder.parameters()), lr=learning_rate)
-    birnn_encoder_optimizer = optim.Adam(filter(lambda p: p.requires_grad, birnn_encoder.parameters()), lr=learning_rate)
-    review_decoder_optimizer = optim.Adam(filter(lambda p: p.requires_grad, review_decoder.parameters()), lr=learning_rate)  
+    # trainable parameters are collected once and reused for gradient clipping
+    encoder_params = [p for p in encoder.parameters() if p.requires_grad]
+    birnn_encoder_params = [p for p in birnn_encoder.parameters() if p.requires_grad]
+    # the shared sketch embedding must appear only once, in the birnn encoder group
+    shared = set(id(p) for p in birnn_encoder_params)
+    review_decoder_params = [p for p in review_decoder.parameters() if p.requires_grad and id(p) not in shared]
+    params = encoder_params + birnn_encoder_params + review_decoder_params
+
+    # one param group per module: encoder, birnn encoder, review decoder.
+    # the fused kernel updates all parameters in a few launches but needs them on cuda
+    optimizer = optim.Adam([
+        {'params': encoder_params},
+        {'params': birnn_encoder_params},
+        {'params': review_decoder_params}
+    ], lr=learning_rate, fused=USE_CUDA)
     
     if loadFilename:
-        encoder_optimizer.load_state_dict(checkpoint['encoder_opt'])
-        birnn_encoder_optimizer.load_state_dict(checkpoint['birnn_encoder_opt'])
-        review_decoder_optimizer.load_state_dict(checkpoint['review_decoder_opt'])
+        if 'optimizer' in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+        else:
+            # older checkpoints hold one Adam state per module (encoder_opt, ...), which does not
+            # map onto the param groups since the sketch embedding is shared, so restart Adam
+            print('No combined optimizer state in {}, starting the optimizer from scratch ...'.format(loadFilename))
+
+    # decay the learning rate of all groups by lr_decay_ratio every lr_decay_epoch epochs
+    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=lr_decay_epoch, gamma=lr_decay_ratio)
+
+    # gradient scaler for mixed precision, disabled without cuda
+    scaler = torch.cuda.amp.GradScaler(enabled=USE_CUDA)
 
     # initialize
     print('Initializing ...')
     step = 0
     epoch = 0
+    print_every = 50
     perplexity = []
     _loss = []
     
     log_path = os.path.join('ckpt/' + corpus_name)
     if not os.path.exists(log_path):
         os.makedirs(log_path)
-    writer = SummaryWriter(log_path)
+    # scalars are queued and written by the writer in the background instead of per step
+    writer = SummaryWriter(log_path, max_queue=200, flush_secs=30)
     
-    best_val_loss = None
+    best_val_loss = float('inf')
+
+    # directory of the best models
+    directory = os.path.join(save_dir, 'model', '{}_{}_{}'.format(n_layers, hidden_size, batch_size))
+    os.makedirs(directory, exist_ok=True)
     
     if loadFilename:
         step = checkpoint['step']
         epoch = checkpoint['epoch'] + 1
         perplexity = checkpoint['plt']
         _loss = checkpoint['loss']
+        if 'scheduler' in checkpoint:
+            # the checkpoint is written before the end-of-epoch step, so take it here
+            scheduler.load_state_dict(checkpoint['scheduler'])
+            scheduler.step()
+        else:
+            # older checkpoints have no scheduler state, put the decay schedule at the resumed epoch
+            print('No scheduler state in {}, resuming the learning rate decay at epoch {} ...'.format(loadFilename, epoch))
+            scheduler.last_epoch = epoch
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = learning_rate * (lr_decay_ratio ** (epoch // lr_decay_epoch))
         for i in range(len(_loss)):
             writer.add_scalar("Train/loss", _loss[i], i)
             writer.add_scalar("Train/perplexity", perplexity[i], i)
 
     while True:
         
-        # learning rate adjust
-        adjust_learning_rate(encoder_optimizer, epoch, learning_rate, lr_decay_epoch, lr_decay_ratio)
-        adjust_learning_rate(birnn_encoder_optimizer, epoch, learning_rate, lr_decay_epoch, lr_decay_ratio)
-        adjust_learning_rate(review_decoder_optimizer, epoch, learning_rate, lr_decay_epoch, lr_decay_ratio)
-        
         # train epoch
         encoder.train()
         birnn_encoder.train()
         review_decoder.train()
         
-        tr_loss = 0   
-        for batch_idx, training_batch in enumerate(training_batches):
-            attr_input, topic_input, sketch_output, review_input, review_output, mask = training_batch
-
-            loss = train(attr_input, topic_input, sketch_output, review_input, review_output, mask, encoder, birnn_encoder, review_decoder, 
-                            encoder_optimizer, birnn_encoder_optimizer, review_decoder_optimizer)
+        tr_loss = torch.zeros((), device=device)
+        pending_losses = []
+        prefetcher = Prefetcher(training_batches)
+        training_batch = prefetcher.next()
+        batch_idx = 0
+        while training_batch is not None:
+            attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths = training_batch
+
+            loss = train(attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths, encoder, birnn_encoder, review_decoder, 
+                            optimizer, params, scaler, use_checkpoint)
             step += 1
 
             tr_loss += loss
+            pending_losses.append(loss)
+
+            training_batch = prefetcher.next()
             
-            _loss.append(loss)
-            perplexity.append(math.exp(loss))    
-            
-            writer.add_scalar("Train/loss", loss, step)
-            writer.add_scalar("Train/perplexity", math.exp(loss), step)
-            
-            print("epoch {} batch {} loss={} perplexity={} en_lr={:05.5f} bi_lr={:05.5f} de_lr={:05.5f}".format(epoch, batch_idx, 
-            loss, math.exp(loss), encoder_optimizer.param_groups[0]['lr'], birnn_encoder_optimizer.param_groups[0]['lr'], 
-            review_decoder_optimizer.param_groups[0]['lr']))
+            # copy the losses to host once per interval instead of syncing every step
+            if len(pending_losses) == print_every or training_batch is None:
+                losses = torch.stack(pending_losses).tolist()
+                for i, l in enumerate(losses):
+                    _loss.append(l)
+                    perplexity.append(math.exp(l))
+                    
+                    writer.add_scalar("Train/loss", l, step - len(losses) + 1 + i)
+                    writer.add_scalar("Train/perplexity", math.exp(l), step - len(losses) + 1 + i)
+                
+                loss = sum(losses) / len(losses)
+                print("epoch {} batch {} loss={} perplexity={} en_lr={:05.5f} bi_lr={:05.5f} de_lr={:05.5f}".format(epoch, batch_idx, 
+                loss, math.exp(loss), optimizer.param_groups[0]['lr'], optimizer.param_groups[1]['lr'], 
+                optimizer.param_groups[2]['lr']))
+                pending_losses = []
+
+            batch_idx += 1
             
-        cur_loss = tr_loss / len(training_batches)
+        cur_loss = tr_loss.item() / len(training_batches)
         
         print('\n' + '-' * 30)
         print('train | epoch {:3d} | average loss {:5.5f} | average ppl {:8.3f}'.format(epoch, cur_loss, math.exp(cur_loss)))
@@ -321,15 +395,17 @@ def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size
         print_loss = 0
             
         # evaluate
-        vl_loss = 0
-        for val_batch in val_batches:
-            attr_input, topic_input, sketch_output, review_input, review_output, mask = val_batch
+        vl_loss = torch.zeros((), device=device)
+        prefetcher = Prefetcher(val_batches)
+        val_batch = prefetcher.next()
+        while val_batch is not None:
+            attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths = val_batch
             
-            loss = evaluate(attr_input, topic_input, sketch_output, review_input, review_output, mask, encoder, birnn_encoder, review_decoder, 
-                            encoder_optimizer, birnn_encoder_optimizer, review_decoder_optimizer)
+            loss = evaluate(attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths, encoder, birnn_encoder, review_decoder)
             
             vl_loss += loss
-        vl_loss /= len(val_batches)
+            val_batch = prefetcher.next()
+        vl_loss = vl_loss.item() / len(val_batches)
         
         writer.add_scalar("Valid/loss", vl_loss, step)
 
@@ -338,35 +414,32 @@ def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size
         print('-' * 30)
         
         # Save the model if the validation loss is the best we've seen so far.
-        model_path = os.path.joion(save_dir, "model")
-        if not best_val_loss or vl_loss < best_val_loss:
-            directory = os.path.join(model_path, '{}_{}_{}'.format(n_layers, hidden_size, batch_size))
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+        if vl_loss < best_val_loss:
             torch.save({
                 'step': step,
                 'epoch': epoch,
                 'encoder': encoder.state_dict(), 
-                'encoder_opt': encoder_optimizer.state_dict(), 
-                'birnn_encoder': birnn_encoder.state_dict(), 
-                'birnn_encoder_opt': birnn_encoder_optimizer.state_dict(),
-                'review_decoder': review_decoder.state_dict(),
-                'review_decoder_opt': review_decoder_optimizer.state_dict(),
+                'birnn_encoder': unwrap(birnn_encoder).state_dict(), 
+                'review_decoder': unwrap(review_decoder).state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
                 'loss': _loss,
                 'plt': perplexity
             }, os.path.join(directory, '{}_{}.tar'.format(epoch, 'review_model')))
             best_val_loss = vl_loss
      
             # Run on test data.
-            ts_loss = 0
-            for test_batch in test_batches:
-                attr_input, topic_input, sketch_output, review_input, review_output, mask = test_batch
+            ts_loss = torch.zeros((), device=device)
+            prefetcher = Prefetcher(test_batches)
+            test_batch = prefetcher.next()
+            while test_batch is not None:
+                attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths = test_batch
 
-                loss = evaluate(attr_input, topic_input, sketch_output, review_input, review_output, mask, encoder, birnn_encoder, review_decoder, 
-                            encoder_optimizer, birnn_encoder_optimizer, review_decoder_optimizer)
+                loss = evaluate(attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths, encoder, birnn_encoder, review_decoder)
                 
                 ts_loss += loss
-            ts_loss /= len(test_batches)
+                test_batch = prefetcher.next()
+            ts_loss = ts_loss.item() / len(test_batches)
             writer.add_scalar("Test/loss", ts_loss, step)
             
             print('\n' + '-' * 30)
@@ -378,6 +451,7 @@ def trainIters(corpus, learning_rate, lr_decay_epoch, lr_decay_ratio, batch_size
             print('validation loss is larger than best validation loss. Break!')
             break
 
+        scheduler.step()
         epoch += 1
         
 
@@ -4,6 +4,7 @@ from torch.autograd import Variable
 from torch import optim
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
+from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pack_padded_sequence
 from masked_cross_entropy import *
 import itertools
@@ -17,6 +18,7 @@ import pickle
 import logging
 import numpy as np
 logging.basicConfig(level=logging.INFO)
+USE_CUDA = torch.cuda.is_available()
     
 #############################################
 # Prepare Training Data
@@ -105,8 +107,9 @@ def ReviewVar(rb, pb, tb, vocab):
     outpadVar = Variable(torch.LongTensor(outpadList))
     sketchVar = Variable(torch.LongTensor(sketchList))
     mask = Variable(torch.ByteTensor(mask))
+    sketchLengths = torch.LongTensor([len(s) for s in sketch_output])  # unpadded sketch lengths, for packing
 
-    return topicVar, sketchVar, inpadVar, outpadVar, mask
+    return topicVar, sketchVar, inpadVar, outpadVar, mask, sketchLengths
 
 # pair_batch is a list of (input, output) with length batch_size
 # sort list of (input, output) pairs by output length, reverse input
@@ -120,6 +123,49 @@ def batch2TrainData(vocab, pair_batch, evaluation=False):
         sketch_batch.append(pair_batch[i][2])
         review_batch.append(pair_batch[i][3])
     attr_input = inputVar(input_batch, vocab, evaluation=evaluation)
-    topic_input, sketch_output, review_input, review_output, mask = ReviewVar(review_batch, sketch_batch, topic_batch, vocab)
-    return attr_input, topic_input, sketch_output, review_input, review_output, mask
+    topic_input, sketch_output, review_input, review_output, mask, sketch_lengths = ReviewVar(review_batch, sketch_batch, topic_batch, vocab)
+    # sketch lengths stay on the host, pack_padded_sequence reads them there
+    return attr_input, topic_input, sketch_output, review_input, review_output, mask, sketch_lengths
 
+
+# raw (attribute, topic, sketch, review) pairs, collated into batches by batch2TrainData
+class PairsDataset(Dataset):
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, idx):
+        return self.pairs[idx]
+
+# overlap host to device copy of the next batch with computation on the current one,
+# following the data_prefetcher of NVIDIA Apex; batches are expected in pinned memory.
+# the trailing sketch lengths of each batch are left on the host
+class Prefetcher(object):
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.stream = torch.cuda.Stream() if USE_CUDA else None
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if self.stream is None:
+            self.next_batch = batch
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = tuple(t.to('cuda', non_blocking=True) for t in batch[:-1]) + (batch[-1],)
+
+    def next(self):
+        batch = self.next_batch
+        if self.stream is not None and batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            # tensors were allocated on the side stream but are consumed on the main one
+            for t in batch[:-1]:
+                t.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch